@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+build_kernels.py
+- Numeric kernels shared by iot_sender.py, written in the numba nopython subset
+- Run `python build_kernels.py` once to AOT-compile them into the `iot_kernels`
+  extension module next to this file (needs numba + a C compiler)
+- iot_sender.py imports `iot_kernels` when present, so the hot kernel needs no
+  JIT warmup; otherwise it JIT-compiles (or runs) the functions defined here
+"""
+
+import os
+
+# gen_tick channel order: temperature, humidity, co2, no2, pm25, pm10
+# adj order:              temp_adj, hum_adj, pollutant_multiplier, no2_adj
+GEN_TICK_SIG = "void(f8[:], f8[:], f8[:], f8[:], f8[:], f8[:])"
+
+def gen_tick(base, adj, noise, lo, hi, out):
+    """One tick of all six channels: adjust base, add noise, clamp to lo/hi, round to 2 dp."""
+    pm = adj[2]
+    out[0] = base[0] + adj[0] + noise[0]
+    out[1] = base[1] + adj[1] + noise[1]
+    out[2] = base[2] * pm + noise[2]
+    out[3] = (base[3] + adj[3]) * pm + noise[3]
+    out[4] = base[4] * pm + noise[4]
+    out[5] = base[5] * pm + noise[5]
+    for k in range(6):
+        out[k] = round(min(hi[k], max(lo[k], out[k])), 2)
+
+def build():
+    from numba.pycc import CC
+
+    cc = CC("iot_kernels")
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export("gen_tick", GEN_TICK_SIG)(gen_tick)
+    cc.compile()
+    print(f"Built iot_kernels in {cc.output_dir}")
+
+if __name__ == "__main__":
+    build()
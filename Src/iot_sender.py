@@ -1,41 +1,78 @@
 #!/usr/bin/env python3
 """
 iot_sender_sun_activity.py
-- Single script, 8 devices (threads)
+- Single script, 8 devices driven by one asyncio scheduler
 - Uses regions.json (contains lat/lon, activity_end, baselines)
-- Uses astral to compute sunrise/sunset per region daily
+- Computes sunrise/sunset per region daily (NOAA solar equations)
 - Temperature begins to fall after sunset
 - Pollution levels begin to drop after activity_end (per-region)
 - Daytime drift: +/-7% per hour (more dynamic)
 - Nighttime drift (post-activity): -5% per hour (smoother decrease)
 - Payload fields are strings: "29.29 °C"
 - NEW: Automatically saves each payload to daily JSONL log file (Logs/YYYY-MM-DD.jsonl)
+- Optional: `python build_kernels.py` precompiles the per-tick kernel (iot_kernels)
 """
 
 import os
 import json
-import time
-import threading
-import random
-from datetime import datetime, date, timedelta
-from astral import LocationInfo
-from astral.sun import sun
+import math
+import atexit
+import asyncio
+import heapq
+import logging
+import logging.handlers
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+# Console logging: records are buffered and written in batches; anything at
+# INFO or above flushes immediately. Per-send payload lines are DEBUG.
+LOG_LEVEL = logging.INFO
+logger = logging.getLogger("iot")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(logging.handlers.MemoryHandler(1024, flushLevel=logging.INFO, target=_console))
 
 try:
-    from azure.iot.device import IoTHubDeviceClient
+    from azure.iot.device import Message
+    from azure.iot.device.aio import IoTHubDeviceClient, IoTHubModuleClient
 except Exception:
-    IoTHubDeviceClient = None
-    print("Warning: 'azure-iot-device' not installed. Running local-only.")
+    IoTHubDeviceClient = IoTHubModuleClient = Message = None
+    logger.warning("Warning: 'azure-iot-device' not installed. Running local-only.")
+
+try:
+    from numba import njit
+except Exception:
+    def njit(*args, **kwargs):
+        """Fallback when numba is missing: kernels run as plain Python."""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+    logger.warning("Warning: 'numba' not installed. Running kernels without JIT.")
+
+try:
+    from iot_kernels import gen_tick        # AOT build from build_kernels.py
+except ImportError:
+    from build_kernels import gen_tick as _gen_tick_py
+    # No fastmath here: it turns round()'s "/ 100" into "* 0.01" and breaks 2-dp output
+    gen_tick = njit(cache=True)(_gen_tick_py)
 
 # ==============================
 # CONFIGURATION
 # ==============================
 DEVICES_FILE = "devices.json"
 REGIONS_FILE = "regions.json"
+# Optional gateway mode: when set, all devices send through this one IoT Edge
+# module connection instead of one connection each. Every message carries a
+# "deviceId" custom property so IoT Hub routing rules can split them again.
+GATEWAY_CONNECTION_STRING = os.environ.get("IOTHUB_GATEWAY_CONNECTION_STRING", "")
 SEND_INTERVAL = 90                # seconds between sends per device
+MAX_CONCURRENT_SENDS = 4          # ticks allowed in flight at once across all devices
 STAGGER_OFFSETS = [0,10,20,30,40,50,60,70]
 ACTIVITY_START_HOUR = 6
 ACTIVITY_START_MIN = 30          # 6:30 AM
+ACTIVITY_START_SOD = ACTIVITY_START_HOUR * 3600 + ACTIVITY_START_MIN * 60   # as seconds of day
 
 UNITS = {
     "temperature": "°C",
@@ -46,6 +83,27 @@ UNITS = {
     "pm10": "µg/m³"
 }
 
+# Column order of the BASE/STATE arrays (same order as the payload fields)
+SENSOR_KEYS = tuple(UNITS)
+NOISE_SIGMA = np.array([0.5, 1.5, 5.0, 1.5, 1.5, 3.0])           # per-tick gaussian noise
+STATE_LO = np.array([-50.0, 0.0, 150.0, 0.0, 0.0, 0.0])          # per-channel clamp bounds
+STATE_HI = np.array([70.0, 100.0, 5000.0, 2000.0, 2000.0, 5000.0])
+BASE_LO, BASE_HI = -1000.0, 10000.0                              # drift clamp bounds
+
+# Per-tick uniform ranges for (temp_adj, hum_adj, pollutant_multiplier, no2_adj),
+# indexed by [is_night][pollution mode]; modes: 0 = quiet (after activity end or
+# before sunrise), 1 = active during the effective day, 2 = active off-hours
+_ADJ_RANGES = [
+    [((0.5, 2.5), (-3.0, -0.5), (0.75, 0.9), (-6.0, -1.0)),
+     ((0.5, 2.5), (-3.0, -0.5), (0.98, 1.08), (2.0, 10.0)),
+     ((0.5, 2.5), (-3.0, -0.5), (0.98, 1.08), (-1.0, 2.0))],
+    [((-3.5, -0.5), (0.5, 4.0), (0.75, 0.9), (-6.0, -1.0)),
+     ((-3.5, -0.5), (0.5, 4.0), (0.98, 1.08), (2.0, 10.0)),
+     ((-3.5, -0.5), (0.5, 4.0), (0.98, 1.08), (-1.0, 2.0))],
+]
+ADJ_LO = np.array([[[lo for lo, _ in r] for r in night] for night in _ADJ_RANGES])
+ADJ_SPAN = np.array([[[hi - lo for lo, hi in r] for r in night] for night in _ADJ_RANGES])
+
 LOG_MODE = True
 LOG_DIR = "Logs"  # folder for daily logs
 
@@ -56,24 +114,176 @@ if LOG_MODE and not os.path.exists(LOG_DIR):
 # ==============================
 # UTILITY FUNCTIONS
 # ==============================
-def log_payload(payload):
-    """Append one payload JSON to daily log file (Logs/YYYY-MM-DD.jsonl)."""
+# Daily log file descriptor (O_APPEND), reopened only when the date rolls over.
+# Each payload is one os.write() of a single line well under PIPE_BUF, which
+# O_APPEND appends atomically, so writers need no lock around the fd.
+_LogState = {"date": None, "fd": None}
+_LOG_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+
+def _log_fd_for(date_str):
+    """Return the open fd for Logs/<date_str>.jsonl."""
+    if _LogState["date"] != date_str:
+        if _LogState["fd"] is not None:
+            os.close(_LogState["fd"])
+            _LogState["fd"] = None
+        log_file = os.path.join(LOG_DIR, f"{date_str}.jsonl")
+        _LogState["fd"] = os.open(log_file, _LOG_OPEN_FLAGS, 0o644)
+        _LogState["date"] = date_str
+    return _LogState["fd"]
+
+def _close_log():
+    """Close the daily log file."""
+    if _LogState["fd"] is not None:
+        os.close(_LogState["fd"])
+        _LogState["fd"] = None
+        _LogState["date"] = None
+
+atexit.register(_close_log)
+
+def log_payload(data, date_str):
+    """Append one UTF-8 encoded payload to the daily log file (Logs/YYYY-MM-DD.jsonl)."""
     if LOG_MODE:
         try:
-            date_str = datetime.now().strftime("%Y-%m-%d")
-            log_file = os.path.join(LOG_DIR, f"{date_str}.jsonl")
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            line = memoryview(data + b"\n")
+            fd = _log_fd_for(date_str)
+            while line:
+                line = line[os.write(fd, line):]   # short writes only on e.g. a full disk
         except Exception as e:
-            print(f"[LOG] Failed to write payload: {e}")
-
-def clamp(v, lo, hi):
-    return max(lo, min(hi, v))
+            logger.error("[LOG] Failed to write payload: %s", e)
+
+def format_ts(dt):
+    """Format dt as 'YYYY-MM-DD HH:MM:SS' without going through strftime."""
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+@njit(cache=True, fastmath=True)
+def _sun_event_minutes(jd0, minutes_utc, cos_lat, tan_lat, lon, rising):
+    """NOAA solar equations: sunrise (rising) or sunset, in minutes after 00:00 UTC of jd0."""
+    jc = (jd0 + minutes_utc / 1440.0 - 2451545.0) / 36525.0
+    geom_mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360.0
+    geom_mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = math.radians(geom_mean_anom)
+    eq_of_ctr = (math.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+                 + math.sin(2.0 * m) * (0.019993 - 0.000101 * jc)
+                 + math.sin(3.0 * m) * 0.000289)
+    omega = math.radians(125.04 - 1934.136 * jc)
+    app_long = math.radians(geom_mean_long + eq_of_ctr - 0.00569 - 0.00478 * math.sin(omega))
+    mean_obliq = 23.0 + (26.0 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60.0) / 60.0
+    obliq = math.radians(mean_obliq + 0.00256 * math.cos(omega))
+    decl = math.asin(math.sin(obliq) * math.sin(app_long))
+
+    y = math.tan(obliq / 2.0) ** 2
+    l0 = math.radians(geom_mean_long)
+    eq_of_time = 4.0 * math.degrees(
+        y * math.sin(2.0 * l0)
+        - 2.0 * eccent * math.sin(m)
+        + 4.0 * eccent * y * math.sin(m) * math.cos(2.0 * l0)
+        - 0.5 * y * y * math.sin(4.0 * l0)
+        - 1.25 * eccent * eccent * math.sin(2.0 * m)
+    )
+
+    # Hour angle for the sun's upper limb on the horizon (90.833 deg: refraction + radius)
+    cos_ha = (math.cos(math.radians(90.833)) / (cos_lat * math.cos(decl))
+              - tan_lat * math.tan(decl))
+    ha = math.degrees(math.acos(min(1.0, max(-1.0, cos_ha))))
+
+    solar_noon = 720.0 - 4.0 * lon - eq_of_time
+    return solar_noon - 4.0 * ha if rising else solar_noon + 4.0 * ha
+
+@njit(cache=True, fastmath=True)
+def sunrise_sunset(year, month, day, cos_lat, tan_lat, lon, tz_offset_hours):
+    """
+    Sunrise and sunset for a date as minutes after midnight at UTC + tz_offset_hours.
+    The location is passed pre-digested (see make_observer).
+    """
+    # Julian day at 00:00 UTC (Meeus)
+    if month <= 2:
+        year -= 1
+        month += 12
+    a = year // 100
+    b = 2 - a + a // 4
+    jd0 = math.floor(365.25 * (year + 4716)) + math.floor(30.6001 * (month + 1)) + day + b - 1524.5
+
+    # First pass around solar noon, second pass at each event's own time
+    noon_guess = 720.0 - 4.0 * lon
+    rise = _sun_event_minutes(jd0, noon_guess, cos_lat, tan_lat, lon, True)
+    sset = _sun_event_minutes(jd0, noon_guess, cos_lat, tan_lat, lon, False)
+    rise = _sun_event_minutes(jd0, rise, cos_lat, tan_lat, lon, True)
+    sset = _sun_event_minutes(jd0, sset, cos_lat, tan_lat, lon, False)
+    return rise + tz_offset_hours * 60.0, sset + tz_offset_hours * 60.0
+
+# Compile once at import so the first cache miss does not pay the JIT cost
+sunrise_sunset(2024, 1, 1, 0.866, 0.577, 31.0, 0.0)
+
+def make_observer(lat, lon):
+    """Location terms for sunrise_sunset that never change: (cos_lat, tan_lat, lon)."""
+    phi = math.radians(lat)
+    return (math.cos(phi), math.tan(phi), lon)
+
+def get_sun_times_for(date_obj, observer):
+    """Aware UTC sunrise/sunset datetimes for date_obj at a make_observer() location."""
+    rise, sset = sunrise_sunset(date_obj.year, date_obj.month, date_obj.day, *observer, 0.0)
+    midnight_utc = datetime(date_obj.year, date_obj.month, date_obj.day, tzinfo=timezone.utc)
+    return {
+        "sunrise": midnight_utc + timedelta(minutes=rise),
+        "sunset": midnight_utc + timedelta(minutes=sset),
+    }
 
-def get_sun_times_for(date_obj, lat, lon, region_name=""):
-    loc = LocationInfo(name=region_name, region=region_name, timezone="Africa/Cairo", latitude=lat, longitude=lon)
-    s = sun(loc.observer, date=date_obj)
-    return {"sunrise": s["sunrise"], "sunset": s["sunset"]}
+# (device index, date) -> local naive sunrise/sunset, computed once per device per day
+_SUN_CACHE = {}
+
+def get_local_sun_times(idx, date_obj, observer):
+    """
+    Cached local naive sunrise/sunset datetimes, their formatted strings and
+    their offsets in seconds from local midnight of date_obj.
+    """
+    key = (idx, date_obj)
+    cached = _SUN_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    sun_times = get_sun_times_for(date_obj, observer)
+    sunset = sun_times["sunset"].astimezone().replace(tzinfo=None)
+    sunrise = sun_times["sunrise"].astimezone().replace(tzinfo=None)
+    midnight = datetime(date_obj.year, date_obj.month, date_obj.day)
+    cached = {
+        "sunset": sunset,
+        "sunrise": sunrise,
+        "sunset_str": format_ts(sunset),
+        "sunrise_str": format_ts(sunrise),
+        "sunset_sod": (sunset - midnight).total_seconds(),
+        "sunrise_sod": (sunrise - midnight).total_seconds(),
+    }
+    # Drop this device's entries for previous days
+    for k in [k for k in _SUN_CACHE if k[0] == idx]:
+        del _SUN_CACHE[k]
+    _SUN_CACHE[key] = cached
+    return cached
+
+def build_payload_template(device_id, region_name, activity_end):
+    """
+    Build the payload JSON for one device as a %-format string.
+    Invariant fields are baked in; per tick fill with
+    (timestamp, temperature, humidity, co2, no2, pm25, pm10, period, sunset, sunrise).
+    Output matches json.dumps(payload, ensure_ascii=False).
+    """
+    def literal(v):
+        return json.dumps(v, ensure_ascii=False).replace("%", "%%")
+
+    fields = [
+        f'"deviceId": {literal(device_id)}',
+        f'"region": {literal(region_name)}',
+        '"timestamp": "%s"',
+    ]
+    for k, unit in UNITS.items():
+        fields.append(f'"{k}": "%s{literal(" " + unit)[1:-1]}"')
+    fields += [
+        '"period": "%s"',
+        '"sunset": "%s"',
+        '"sunrise": "%s"',
+        f'"activity_end_hour": {activity_end}',
+    ]
+    return "{" + ", ".join(fields) + "}"
 
 # ==============================
 # LOAD DEVICES & REGIONS
@@ -84,7 +294,11 @@ with open(DEVICES_FILE, "r", encoding="utf-8") as f:
 with open(REGIONS_FILE, "r", encoding="utf-8") as f:
     regions = json.load(f)
 
-device_entries = []
+# Flat struct-of-arrays layout: device i is row/element i of everything below
+DEV_IDS = []
+CONN_STRS = []
+REGION_NAMES = []
+_rows = []
 for idx, d in enumerate(devices):
     deviceId = d.get("deviceId")
     conn = d.get("connectionString")
@@ -92,164 +306,234 @@ for idx, d in enumerate(devices):
         raise ValueError(f"Invalid entry in {DEVICES_FILE} at index {idx}: {d}")
     if deviceId not in regions:
         raise ValueError(f"DeviceId '{deviceId}' not found in {REGIONS_FILE}.")
-    device_entries.append({"deviceId": deviceId, "connectionString": conn, "index": idx})
-
-runtime = {}
-for entry in device_entries:
-    did = entry["deviceId"]
-    r = regions[did]
-    base = {k: float(r[k]) for k in ("temperature","humidity","co2","no2","pm25","pm10")}
-    runtime[did] = {
-        "base": base.copy(),
-        "state": base.copy(),
-        "lat": float(r["lat"]),
-        "lon": float(r["lon"]),
-        "activity_end": int(r.get("activity_end", 22))
-    }
-
-last_drift_hour = {did: None for did in runtime.keys()}
+    DEV_IDS.append(deviceId)
+    CONN_STRS.append(conn)
+    REGION_NAMES.append(regions[deviceId].get("region_name", deviceId))
+    _rows.append(regions[deviceId])
+
+N_DEVICES = len(DEV_IDS)
+DID_TO_IDX = {did: i for i, did in enumerate(DEV_IDS)}
+
+BASE = np.array([[float(r[k]) for k in SENSOR_KEYS] for r in _rows])
+STATE = BASE.copy()
+LAT = np.array([float(r["lat"]) for r in _rows])
+LON = np.array([float(r["lon"]) for r in _rows])
+ACTIVITY_END = np.array([int(r.get("activity_end", 22)) for r in _rows], dtype=np.int8)
+
+# Per-tick scalars and objects stay in plain lists (cheaper to index than numpy scalars)
+# activity_end == 0 means midnight at the end of the day
+ACTIVITY_END_SOD = [int(ae) * 3600 if ae else 86400 for ae in ACTIVITY_END]
+OBSERVERS = [make_observer(lat, lon) for lat, lon in zip(LAT.tolist(), LON.tolist())]
+TMPLS = [build_payload_template(DEV_IDS[i], REGION_NAMES[i], int(ACTIVITY_END[i])) for i in range(N_DEVICES)]
+# Independent random stream per device, so no generator state is shared between devices
+RNGS = [np.random.default_rng(seed) for seed in np.random.SeedSequence().spawn(N_DEVICES)]
+CLIENTS = [None] * N_DEVICES
+LAST_DRIFT_HOUR = [None] * N_DEVICES
+# Cached day/activity gates per device and the window [from, until) they hold for
+GATES = [None] * N_DEVICES
+GATE_FROM = [datetime.max] * N_DEVICES
+NEXT_TRANSITION = [datetime.min] * N_DEVICES
 
 # ==============================
 # DRIFT LOGIC
 # ==============================
-def apply_hourly_drift_for_device(did, is_daytime_flag):
-    b = runtime[did]["base"]
-    if is_daytime_flag:
-        pct = 0.07
-        for k in b.keys():
-            change = b[k] * pct
-            b[k] = clamp(b[k] + random.uniform(-change, change), -1000, 10000)
+@njit(cache=True, fastmath=True)
+def _drift(base_arr, pct, daytime, out):
+    """Daytime: base +/- uniform(pct); night: base - uniform(0, pct). Clamped to BASE_LO/BASE_HI."""
+    for k in range(base_arr.shape[0]):
+        change = base_arr[k] * pct
+        if daytime:
+            v = base_arr[k] + np.random.uniform(-change, change)
+        else:
+            v = base_arr[k] - np.random.uniform(0.0, change)
+        out[k] = min(BASE_HI, max(BASE_LO, v))
+
+# Compile once at import so the first hourly drift does not pay the JIT cost
+_drift(np.ones(len(SENSOR_KEYS)), 0.05, False, np.empty(len(SENSOR_KEYS)))
+
+def apply_hourly_drift_for_device(i, is_daytime_flag):
+    b = BASE[i]
+    _drift(b, 0.07 if is_daytime_flag else 0.05, is_daytime_flag, b)
+
+# ==============================
+# DAY / ACTIVITY GATES
+# ==============================
+def update_gates(i, now):
+    """
+    Recompute device i's gates for `now` and the time they next change: sunrise,
+    sunset, activity start/end or midnight, whichever comes first.
+    GATES[i] = (is_night, pollution mode, is_effective_day, sun_times); pollution
+    modes are those of ADJ_LO/ADJ_SPAN.
+    """
+    sun_times = get_local_sun_times(i, now.date(), OBSERVERS[i])
+    sod = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+
+    is_after_sunset = sod >= sun_times["sunset_sod"]
+    is_before_sunrise = sod < sun_times["sunrise_sod"]
+    is_after_activity_end = sod >= ACTIVITY_END_SOD[i]
+    is_effective_day = ACTIVITY_START_SOD <= sod < ACTIVITY_END_SOD[i]
+
+    is_night = is_after_sunset or is_before_sunrise
+    if is_after_activity_end or is_before_sunrise:
+        mode = 0
     else:
-        pct = 0.05
-        for k in b.keys():
-            change = b[k] * pct
-            b[k] = clamp(b[k] - random.uniform(0, change), -1000, 10000)
+        mode = 1 if is_effective_day else 2
+
+    boundaries = (sun_times["sunrise_sod"], sun_times["sunset_sod"],
+                  ACTIVITY_START_SOD, ACTIVITY_END_SOD[i], 86400)
+    next_sod = min(b for b in boundaries if b > sod)
+    midnight = datetime(now.year, now.month, now.day)
+
+    GATES[i] = (is_night, mode, is_effective_day, sun_times)
+    GATE_FROM[i] = now
+    NEXT_TRANSITION[i] = midnight + timedelta(seconds=next_sod)
 
 # ==============================
-# DEVICE LOOP
+# DEVICE TICK
 # ==============================
-def device_loop(device_entry, offset_seconds):
-    deviceId = device_entry["deviceId"]
-    conn_str = device_entry["connectionString"]
+async def connect_device(i):
+    deviceId = DEV_IDS[i]
+    conn_str = CONN_STRS[i]
 
     client = None
     if IoTHubDeviceClient:
         try:
             client = IoTHubDeviceClient.create_from_connection_string(conn_str)
-            print(f"[{deviceId}] Connected to IoT Hub.")
+            await client.connect()
+            logger.info("[%s] Connected to IoT Hub.", deviceId)
         except Exception as e:
-            print(f"[{deviceId}] Warning: cannot connect to IoT Hub: {e}")
+            # A created client still reconnects on the next send
+            logger.warning("[%s] Warning: cannot connect to IoT Hub: %s", deviceId, e)
     else:
-        print(f"[{deviceId}] Running local-only (azure-iot-device not installed).")
-
-    time.sleep(offset_seconds)
-
-    while True:
-        now = datetime.now()
-        today = date.today()
-        d = runtime[deviceId]
-        lat, lon = d["lat"], d["lon"]
-
-        sun_times = get_sun_times_for(today, lat, lon, d.get("region",""))
-        sunset_local_naive = sun_times["sunset"].astimezone().replace(tzinfo=None)
-        sunrise_local_naive = sun_times["sunrise"].astimezone().replace(tzinfo=None)
-
-        activity_start = now.replace(hour=ACTIVITY_START_HOUR, minute=ACTIVITY_START_MIN, second=0, microsecond=0)
-        ae = d["activity_end"]
-        activity_end_dt = now.replace(hour=ae, minute=0, second=0, microsecond=0)
-        if ae == 0:
-            activity_end_dt += timedelta(days=1)
-
-        is_after_sunset = now >= sunset_local_naive
-        is_before_sunrise = now < sunrise_local_naive
-        is_after_activity_end = now >= activity_end_dt
-        is_effective_day = (now >= activity_start and now < activity_end_dt)
-
-        current_hour = now.hour
-        if last_drift_hour[deviceId] != current_hour:
-            apply_hourly_drift_for_device(deviceId, is_effective_day)
-            last_drift_hour[deviceId] = current_hour
-            print(f"[{deviceId}] Hourly drift applied (day={is_effective_day}) at {now.strftime('%Y-%m-%d %H:%M:%S')}")
-
-        base = d["base"]
-        state = d["state"]
-
-        if is_after_sunset or is_before_sunrise:
-            temp_adj = random.uniform(-3.5, -0.5)
-            hum_adj = random.uniform(0.5, 4.0)
-        else:
-            temp_adj = random.uniform(0.5, 2.5)
-            hum_adj = random.uniform(-3.0, -0.5)
-
-        if is_after_activity_end or is_before_sunrise:
-            pollutant_multiplier = random.uniform(0.75, 0.9)
-            no2_adj = random.uniform(-6.0, -1.0)
-        else:
-            pollutant_multiplier = random.uniform(0.98, 1.08)
-            no2_adj = random.uniform(2.0, 10.0) if is_effective_day else random.uniform(-1.0, 2.0)
-
-        temp = clamp(base["temperature"] + temp_adj + random.gauss(0, 0.5), -50, 70)
-        hum = clamp(base["humidity"] + hum_adj + random.gauss(0, 1.5), 0, 100)
-        co2 = clamp(base["co2"] * pollutant_multiplier + random.gauss(0, 5.0), 150, 5000)
-        no2 = clamp((base["no2"] + no2_adj) * pollutant_multiplier + random.gauss(0, 1.5), 0, 2000)
-        pm25 = clamp(base["pm25"] * pollutant_multiplier + random.gauss(0, 1.5), 0, 2000)
-        pm10 = clamp(base["pm10"] * pollutant_multiplier + random.gauss(0, 3.0), 0, 5000)
-
-        state.update({
-            "temperature": round(temp, 2),
-            "humidity": round(hum, 2),
-            "co2": round(co2, 2),
-            "no2": round(no2, 2),
-            "pm25": round(pm25, 2),
-            "pm10": round(pm10, 2)
-        })
-
-        payload = {
-            "deviceId": deviceId,
-            "region": regions[deviceId].get("region_name", deviceId),
-            "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"),
-            "temperature": f"{state['temperature']} {UNITS['temperature']}",
-            "humidity": f"{state['humidity']} {UNITS['humidity']}",
-            "co2": f"{state['co2']} {UNITS['co2']}",
-            "no2": f"{state['no2']} {UNITS['no2']}",
-            "pm25": f"{state['pm25']} {UNITS['pm25']}",
-            "pm10": f"{state['pm10']} {UNITS['pm10']}",
-            "period": "night" if (is_after_sunset or is_before_sunrise) else "day",
-            "sunset": sunset_local_naive.strftime("%Y-%m-%d %H:%M:%S"),
-            "sunrise": sunrise_local_naive.strftime("%Y-%m-%d %H:%M:%S"),
-            "activity_end_hour": d["activity_end"]
-        }
-
-        text = json.dumps(payload, ensure_ascii=False)
+        logger.info("[%s] Running local-only (azure-iot-device not installed).", deviceId)
+    return client
 
+async def connect_gateway():
+    """One shared IoTHubModuleClient for gateway mode (GATEWAY_CONNECTION_STRING)."""
+    client = None
+    if IoTHubModuleClient:
         try:
-            if client:
-                client.send_message(text)
-                print(f"[{deviceId}] Sent to IoT Hub: {payload}")
-            else:
-                print(f"[{deviceId}] (local) Sent: {payload}")
-            log_payload(payload)  # ✅ Save to daily log file
+            client = IoTHubModuleClient.create_from_connection_string(GATEWAY_CONNECTION_STRING)
+            await client.connect()
+            logger.info("[gateway] Connected to IoT Hub for %d devices.", N_DEVICES)
         except Exception as e:
-            print(f"[{deviceId}] Send failed: {e}")
-
-        time.sleep(SEND_INTERVAL)
+            # A created client still reconnects on the next send
+            logger.warning("[gateway] Warning: cannot connect to IoT Hub: %s", e)
+    else:
+        logger.info("[gateway] Running local-only (azure-iot-device not installed).")
+    return client
+
+async def device_tick(i):
+    """Compute, send and log one payload for device i."""
+    deviceId = DEV_IDS[i]
+    client = CLIENTS[i]
+    base = BASE[i]
+    state = STATE[i]
+    rng = RNGS[i]
+
+    now = datetime.now()
+    ts = format_ts(now)
+
+    # Gates only change at a handful of known times a day (a clock step backwards also recomputes)
+    if not (GATE_FROM[i] <= now < NEXT_TRANSITION[i]):
+        update_gates(i, now)
+    is_night, mode, is_effective_day, sun_times = GATES[i]
+
+    current_hour = now.hour
+    if LAST_DRIFT_HOUR[i] != current_hour:
+        apply_hourly_drift_for_device(i, is_effective_day)
+        LAST_DRIFT_HOUR[i] = current_hour
+        logger.info("[%s] Hourly drift applied (day=%s) at %s", deviceId, is_effective_day, ts)
+
+    # (temp_adj, hum_adj, pollutant_multiplier, no2_adj)
+    adj = ADJ_LO[int(is_night), mode] + ADJ_SPAN[int(is_night), mode] * rng.random(4)
+    noise = NOISE_SIGMA * rng.standard_normal(len(SENSOR_KEYS))
+    gen_tick(base, adj, noise, STATE_LO, STATE_HI, state)
+    temp, hum, co2, no2, pm25, pm10 = state.tolist()
+
+    text = TMPLS[i] % (
+        ts,
+        temp, hum, co2, no2, pm25, pm10,
+        "night" if is_night else "day",
+        sun_times["sunset_str"],
+        sun_times["sunrise_str"],
+    )
+    # Encode once; the same bytes go to IoT Hub and to the log file
+    data = text.encode("utf-8")
+
+    try:
+        if client:
+            if GATEWAY_CONNECTION_STRING:
+                msg = Message(data, content_encoding="utf-8", content_type="application/json")
+                msg.custom_properties["deviceId"] = deviceId
+                await client.send_message(msg)
+            else:
+                await client.send_message(data)
+            logger.debug("[%s] Sent to IoT Hub: %s", deviceId, text)
+        else:
+            logger.debug("[%s] (local) Sent: %s", deviceId, text)
+        log_payload(data, ts[:10])  # ✅ Save to daily log file
+    except Exception as e:
+        logger.error("[%s] Send failed: %s", deviceId, e)
 
 # ==============================
-# START THREADS
+# SCHEDULER
 # ==============================
-threads = []
-for i, entry in enumerate(device_entries):
-    offset = STAGGER_OFFSETS[i % len(STAGGER_OFFSETS)]
-    t = threading.Thread(target=device_loop, args=(entry, offset), daemon=True)
-    t.start()
-    threads.append(t)
-    print(f"Started thread for {entry['deviceId']} with offset {offset}s")
+async def scheduler():
+    """
+    One timer for all devices: each device ticks at its stagger offset and then
+    every SEND_INTERVAL on a fixed cadence. At most MAX_CONCURRENT_SENDS ticks
+    run at once; a device whose previous tick is still running skips a beat.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+    running = {}
+
+    async def run_tick(i):
+        async with sem:
+            try:
+                await device_tick(i)
+            except Exception as e:
+                logger.exception("[%s] Tick failed: %s", DEV_IDS[i], e)
+
+    start = loop.time()
+    heap = [(start + STAGGER_OFFSETS[i % len(STAGGER_OFFSETS)], i) for i in range(N_DEVICES)]
+    heapq.heapify(heap)
+
+    while True:
+        due, i = heap[0]
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        heapq.heapreplace(heap, (due + SEND_INTERVAL, i))
+
+        if i in running:
+            logger.warning("[%s] Previous send still in progress, skipping this interval.", DEV_IDS[i])
+            continue
+        task = asyncio.create_task(run_tick(i))
+        running[i] = task
+        task.add_done_callback(lambda _t, i=i: running.pop(i, None))
 
 # ==============================
-# MAIN LOOP
+# MAIN
 # ==============================
+async def main():
+    if GATEWAY_CONNECTION_STRING:
+        CLIENTS[:] = [await connect_gateway()] * N_DEVICES
+    else:
+        # Open all IoT Hub connections concurrently rather than one after another
+        CLIENTS[:] = await asyncio.gather(*(connect_device(i) for i in range(N_DEVICES)))
+    for i in range(N_DEVICES):
+        offset = STAGGER_OFFSETS[i % len(STAGGER_OFFSETS)]
+        logger.info("Scheduled %s with offset %ss", DEV_IDS[i], offset)
+
+    try:
+        await scheduler()
+    finally:
+        unique_clients = {id(c): c for c in CLIENTS if c}.values()
+        await asyncio.gather(*(c.shutdown() for c in unique_clients), return_exceptions=True)
+
 try:
-    while True:
-        time.sleep(1)
+    asyncio.run(main())
 except KeyboardInterrupt:
-    print("Stopping simulator...")
+    logger.info("Stopping simulator...")